@@ -0,0 +1,13 @@
+import logging
+
+from pymeasure.log import console_log
+
+
+def enable_console_logging( level = logging.DEBUG ):
+    """
+    Log messages from all modules of the package to the console.
+
+    :param level: Minimum level of messages to log. [Default: logging.DEBUG]
+    """
+    log = logging.getLogger( __name__ )
+    console_log( log, level = level )
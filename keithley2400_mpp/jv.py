@@ -4,7 +4,6 @@ import time
 import logging
 
 import numpy as np
-from pymeasure.log import console_log
 from pymeasure.experiment import (
     BooleanParameter,
     FloatParameter,
@@ -15,12 +14,8 @@ from .keithley2400_procedure import Keithley2400_Procedure
 
 
 # setup logging
-log_level = logging.DEBUG
-
 log = logging.getLogger( __name__ )
 log.addHandler( logging.NullHandler() )
-console_log( log, level = log_level )
-log.debug( 'Debug logging enabled.' )
 
 
 class JVScan_Procedure( Keithley2400_Procedure ):
@@ -59,7 +54,7 @@ class JVScan_Procedure( Keithley2400_Procedure ):
         """
         super().startup()
 
-        self.instrument.write( ':format:data ascii' )
+        self.set_data_format( binary = True )
         self.instrument.apply_voltage(
             compliance_current = self.max_current
         )
@@ -71,24 +66,37 @@ class JVScan_Procedure( Keithley2400_Procedure ):
         # sweep parameters
         log.debug( 'Setting sweep parameters.' )
 
+        if self.voltage_step == 0:
+            raise ValueError( 'Voltage step must be non-zero.' )
+
         voltage_step = self.voltage_step
         if (  # account for sweep direction
             ( ( self.start_voltage > self.end_voltage ) and ( self.voltage_step > 0 ) ) or
             ( ( self.start_voltage < self.end_voltage ) and ( self.voltage_step < 0 ) )
         ):
             voltage_step *= -1
-        
-        self.instrument.write( f':source:voltage:start {self.start_voltage}' )
-        self.instrument.write( f':source:voltage:stop {self.end_voltage}' )
-        self.instrument.write( f':source:voltage:step {voltage_step}' )
-        self.instrument.write(  ':source:voltage:mode sweep' )  # set sweep mode
-        self.instrument.write(  ':source:sweep:spacing linear' )  # set to linear sweep
-
-        sweep_points = int( self.instrument.ask( ':source:sweep:points?' ) )
-        self.run_time = sweep_points* ( self.settle_time + self.buffer_points* 0.02 )
 
-        self.instrument.write( f':trigger:count {sweep_points}' )
-        self.instrument.write( f':source:delay {self.settle_time}' )
+        # compute number of points locally, instead of querying the instrument
+        sweep_points = int( round( abs( self.end_voltage - self.start_voltage )/ abs( self.voltage_step ) ) ) + 1
+        self._sweep_points = sweep_points
+        self.run_time = sweep_points* ( self.settle_time + self.buffer_points* 0.02 )
+        self._poll_interval = max( self.settle_time/ 2, 0.01 )
+
+        # send sweep configuration as a single compound command
+        self.instrument.write( ';'.join( [
+            f':source:voltage:start {self.start_voltage}',
+            f':source:voltage:stop {self.end_voltage}',
+            f':source:voltage:step {voltage_step}',
+             ':source:voltage:mode sweep',  # set sweep mode
+             ':source:sweep:spacing linear',  # set to linear sweep
+            f':trigger:count {sweep_points}',
+            f':source:delay {self.settle_time}',
+
+            # store sweep in trace buffer
+             ':trace:clear',
+            f':trace:points {sweep_points}',
+             ':trace:feed sense'
+        ] ) )
 
         time.sleep( 0.1 )  # wait to give instrument time to react
 
@@ -107,6 +115,28 @@ class JVScan_Procedure( Keithley2400_Procedure ):
             self._sweep( -1 )
 
 
+    async def await_sweep( self, direction = 1 ):
+        """
+        Perform a single sweep, yielding to the event loop
+        while the instrument measures.
+        Allows sweeps on multiple instruments to run concurrently.
+
+        :param direction: If 1 sweep from start to end,
+            if -1 sweep from end to start.
+        """
+        log.debug( '#await_sweep' )
+
+        self._initiate_sweep( direction )
+
+        # wait for measurement to complete
+        completed = await self.await_idle(
+            self.run_time* 1.5,
+            interval = self._poll_interval
+        )
+
+        self._finish_sweep( completed )
+
+
     def _sweep( self, direction = 1 ):
         """
         Perform a single sweep.
@@ -116,35 +146,80 @@ class JVScan_Procedure( Keithley2400_Procedure ):
         """
         log.debug( '#_sweep' )
 
+        self._initiate_sweep( direction )
+
+        # wait for measurement to complete
+        completed = self.wait_for_idle(
+            self.run_time* 1.5,
+            interval = self._poll_interval
+        )
+
+        self._finish_sweep( completed )
+
+
+    def _finish_sweep( self, completed ):
+        """
+        Reads the sweep data once the sweep has ended.
+
+        :param completed: Whether the sweep completed in the expected time.
+        """
+        if not completed:
+            log.warning( 'Sweep did not complete in expected time.' )
+
+        self._read_sweep()
+
+
+    def _initiate_sweep( self, direction = 1 ):
+        """
+        Sets the sweep direction and starts the sweep.
+        Does not wait for the sweep to complete.
+
+        :param direction: If 1 sweep from start to end,
+            if -1 sweep from end to start.
+        """
+        log.debug( '#_initiate_sweep' )
+
         # set sweep direciton
         if direction == 1:
             # sweep start to end
-            self.instrument.write( ':source:sweep:direction up' )
+            sweep_direction = 'up'
             log.debug( 'Performing sweep up.' )
 
         elif direction == -1:
             # sweep end to start
-            self.instrument.write( ':source:sweep:direction down' )
+            sweep_direction = 'down'
             log.debug( 'Performing sweep down.' )
             
         else:
             raise ValueError( 'Direction must be +1 or -1.' )
 
-        # initialize sweep
+        # initialize sweep, as a single compound command
         log.debug( 'Initializing sweep' )
-        
-        self.instrument.write( 'initiate' )
-        time.sleep( self.run_time* 1.1 )  # wait for measurement to complete
-        data = self.instrument.ask( 'fetch?' )  # get data
+        self._flush_input()
+        self.instrument.write( ';'.join( [
+            f':source:sweep:direction {sweep_direction}',
+             ':trace:clear',
+             ':trace:feed:control next',  # fill buffer
+             ':initiate'
+        ] ) )
+
+
+    def _read_sweep( self ):
+        """
+        Fetches and saves the data of a completed sweep.
+        """
+        log.debug( '#_read_sweep' )
+
+        data = self.fetch_data( ':trace:data?', points = self._sweep_points )  # get data from buffer
         data = self.format_data( data )
 
-        for datum in data:
-            voltage = datum[ self.elements.index( 'VOLT' ) ]
-            current = datum[ self.elements.index( 'CURR' ) ]
-            power = current* voltage
+        # extract columns once, compute power vectorized
+        voltages = data[ :, self._volt_idx ]
+        currents = data[ :, self._curr_idx ]
+        powers = voltages* currents
 
-            self.emit( 'results', {
-                'voltage [V]': voltage,
-                'current [A]': current,
-                'power [W]':   power
-            } )
+        self._emit_batch( {
+            'voltage [V]': voltages,
+            'current [A]': currents,
+            'power [W]':   powers
+        } )
@@ -1,8 +1,11 @@
 import time
+import asyncio
 import logging
+import warnings
+import threading
 
 import numpy as np
-from pymeasure.log import console_log
+from pyvisa import constants as visa_constants
 from pymeasure.instruments.keithley import Keithley2400
 from pymeasure.experiment import (
     Procedure,
@@ -12,12 +15,8 @@ from pymeasure.experiment import (
 
 
 # setup logging
-log_level = logging.DEBUG
-
 log = logging.getLogger( __name__ )
 log.addHandler( logging.NullHandler() )
-console_log( log, level = log_level )
-log.debug( 'Debug logging enabled.' )
 
 
 class Keithley2400_Procedure( Procedure ):
@@ -31,10 +30,46 @@ class Keithley2400_Procedure( Procedure ):
         [Default: True]
     """
 
+    IDLE_BIT = 1 << 10  # idle bit of the operation condition register
+
+    # restores settings changed by a procedure that the next one relies on,
+    # when a shared instrument is not reset.
+    # source function, compliance, level, elements, data format, buffer size
+    # and terminals are set by each procedure at startup.
+    RESTORE_COMMANDS = [
+        ':source:voltage:mode fixed',  # jv sweep
+        ':source:current:mode fixed',
+        ':source:delay:auto on',  # jv settle time
+        ':arm:source immediate',  # mpp batch acquisition
+        ':arm:count 1',
+        ':trigger:count 1',  # jv sweep, buffer acquisition
+        ':trigger:delay 0',
+        ':trace:clear',  # jv sweep, buffer acquisition
+        ':trace:feed sense',
+        ':trace:feed:control never',
+        ':sense:function:concurrent on',  # voc measures voltage only
+        ':sense:function:on "VOLT:DC","CURR:DC"'
+    ]
+
     # instrument parameters
     port = Parameter( 'Port', default = None )
     use_front_terminals = BooleanParameter( 'Use front terminals', default = True )
 
+    # state defaults, until set
+    __instrument = None
+    __elements = None
+    __binary_data = False
+    __binary_dtype = '<f4'
+    _shared_instrument = None
+    _reset_shared = True
+    _flush_supported = True
+
+
+    def __init__( self, **kwargs ):
+        # created before startup so #stop and waits can be used at any time
+        self._stop_event = threading.Event()
+        super().__init__( **kwargs )
+
 
     @property
     def instrument( self ):
@@ -42,14 +77,7 @@ class Keithley2400_Procedure( Procedure ):
         :returns: Reference to the instrument
             or None if it has not yet been created.
         """
-        log.debug( '.instrument' )
-
-        try:
-            return self.__instrument
-
-        except AttributeError as err:
-            # procedure not yet started
-            return None
+        return self.__instrument
 
 
     @property
@@ -58,14 +86,16 @@ class Keithley2400_Procedure( Procedure ):
         :returns: List of measurement elements
             or None if they have not yet been quried.
         """
-        log.debug( '.elements' )
+        return self.__elements
 
-        try:
-            return self.__elements
 
-        except AttributeError as err:
-            # elements not yet set
-            return None
+    @property
+    def binary_data( self ):
+        """
+        :returns: True if binary data transfer is used,
+            False otherwise.
+        """
+        return self.__binary_data
 
 
     def startup( self ):
@@ -74,12 +104,35 @@ class Keithley2400_Procedure( Procedure ):
         """
         log.debug( '#startup' )
 
-        if self.port is None:
-            raise RuntimeError( 'Port has not been set.' )
+        # stop requests from the worker also set the stop event
+        worker_should_stop = self.should_stop
+
+        def should_stop():
+            if worker_should_stop():
+                self._stop_event.set()
 
-        log.debug( 'Connecting and configuring the instrument.' )
-        self.__instrument = Keithley2400( self.port )
-        self.instrument.reset()  # apply voltage, measure current
+            return self._stop_event.is_set()
+
+        self.should_stop = should_stop
+
+        shared = self._shared_instrument
+        if shared is None:
+            if self.port is None:
+                raise RuntimeError( 'Port has not been set.' )
+
+            log.debug( 'Connecting and configuring the instrument.' )
+            self.__instrument = Keithley2400( self.port )
+            self.instrument.reset()  # apply voltage, measure current
+
+        else:
+            log.debug( 'Using shared instrument.' )
+            self.__instrument = shared
+            if self._reset_shared:
+                self.instrument.reset()
+
+            else:
+                # only restore settings other procedures may have changed
+                self.instrument.write( ';'.join( self.RESTORE_COMMANDS ) )
 
         # set terminals
         log.debug( 'Setting terminals.' )
@@ -90,6 +143,21 @@ class Keithley2400_Procedure( Procedure ):
             self.instrument.use_rear_terminals()
 
 
+    def use_shared_instrument( self, instrument, reset = True ):
+        """
+        Use an existing instrument instead of connecting to the port at startup.
+        Allows consecutive procedures to share one connection.
+
+        :param instrument: Keithley2400 to use.
+        :param reset: If True the instrument is reset at startup.
+            If False only settings changed by other procedures,
+            listed in RESTORE_COMMANDS, are restored.
+            [Default: True]
+        """
+        self._shared_instrument = instrument
+        self._reset_shared = reset
+
+
     def shutdown(self):
         log.debug( '#shutdown' )
 
@@ -114,31 +182,182 @@ class Keithley2400_Procedure( Procedure ):
         This reshapes the data into a 2D array where rows 
         represent measurements, and columns are the fields.
 
-        :param data: 1D numpy.array of data to format.
+        :param data: 1D numpy.array, ASCII string, 
+            or binary block of data to format.
         :returns: 2D numpy.array of formatted data.
         """
-        log.debug( '#format_data' )
-
         # convert to numpy array
-        if isinstance( data, str ):
-            data = data.split( ',' )
-
-        if not isinstance( data, np.ndarray ):
+        if isinstance( data, ( bytes, bytearray ) ):
+            # binary data, in the set format with swapped byte order
+            dtype = np.dtype( self.__binary_dtype )
+            data = np.frombuffer( self._block_payload( data, dtype.itemsize ), dtype = dtype )
+
+        elif isinstance( data, str ):
+            # parse directly, without intermediate list of strings
+            # parsing stops at an invalid value with only a warning
+            with warnings.catch_warnings():
+                warnings.simplefilter( 'error', DeprecationWarning )
+                try:
+                    data = np.fromstring( data, sep = ',', dtype = np.float64 )
+
+                except DeprecationWarning as err:
+                    raise ValueError( 'Invalid data. Could not parse values.' ) from err
+
+        elif not isinstance( data, np.ndarray ):
             # data is not a numpy array
-            # try to convert
-            data = np.array( data, dtype = np.float64 )
+            # try to convert, without copying if possible
+            data = np.asarray( data, dtype = np.float64 )
         
         # format data into rows of measurements
-        cols = len( self.elements )
-        rows = data.shape[ 0 ]/ cols
-        if not rows.is_integer():
+        cols = self._cols
+        if data.size % cols:
             raise ValueError( 'Invalid data length. Data is not divisible by number of elements.' )
 
-        rows = int( rows )
-        data = data.reshape( rows, cols )
+        data = data.reshape( -1, cols )
         return data
 
 
+    @staticmethod
+    def _block_payload( data, itemsize ):
+        """
+        Strips the IEEE-488.2 block header, #<n><length>,
+        and any trailing terminator from binary data.
+
+        :param data: Binary data, with or without a block header.
+        :param itemsize: Number of bytes per value.
+        :returns: Binary payload.
+        """
+        if data[ :1 ] != b'#':
+            # no header
+            return data[ : len( data ) - len( data )% itemsize ]
+
+        digits = int( data[ 1:2 ] )
+        if digits == 0:
+            # indefinite length, drop terminator
+            payload = data[ 2: ]
+            return payload[ : len( payload ) - len( payload )% itemsize ]
+
+        length = int( data[ 2 : 2 + digits ] )
+        start = 2 + digits
+        return data[ start : start + length ]
+
+
+    def _emit_batch( self, columns ):
+        """
+        Emit multiple rows of results at once.
+
+        :param columns: Dictionary of { column name: values },
+            where all values have the same length.
+        """
+        names = list( columns.keys() )
+        values = [
+            ( vals.tolist() if isinstance( vals, np.ndarray ) else vals )
+            for vals in columns.values()
+        ]
+
+        for row in zip( *values ):
+            self.emit( 'results', dict( zip( names, row ) ) )
+
+
+    def set_data_format( self, binary = True, bits = 32 ):
+        """
+        Sets the data transfer format.
+
+        :param binary: If True use binary transfer,
+            falling back to ASCII if the instrument rejects it.
+            If False use ASCII transfer.
+            [Default: True]
+        :param bits: Size of binary values, either 32 or 64.
+            32 bits is sufficient for the instrument's resolution.
+            [Default: 32]
+        :returns: True if binary transfer is used, False otherwise.
+        """
+        log.debug( '#set_data_format' )
+
+        if bits not in ( 32, 64 ):
+            raise ValueError( 'Bits must be 32 or 64.' )
+
+        if binary:
+            self.instrument.write( f':format:data real,{bits}' )
+            self.instrument.write( ':format:border swapped' )  # little endian
+
+            fmt = self.instrument.ask( ':format:data?' ).strip().upper()
+            if not fmt.startswith( 'ASC' ):
+                self.__binary_data = True
+                self.__binary_dtype = f'<f{bits// 8}'
+                return True
+
+            log.warning( 'Binary data format not accepted. Using ASCII.' )
+
+        self.instrument.write( ':format:data ascii' )
+        self.__binary_data = False
+        return False
+
+
+    def fetch_data( self, command = 'fetch?', points = None ):
+        """
+        Queries data from the instrument using the set data format.
+        In binary format the instrument sends an indefinite length block, #0,
+        so the number of values must be known to read it as an array.
+
+        :param command: Query command. [Default: 'fetch?']
+        :param points: Number of readings expected,
+            each with a value for every element,
+            or None if unknown.
+            [Default: None]
+        :returns: numpy.array of data if binary transfer is used
+            and the number of readings is known,
+            the raw binary block if it is not known,
+            otherwise the ASCII response.
+        """
+        if not self.binary_data:
+            return self.instrument.ask( command )
+
+        connection = self.instrument.adapter.connection
+        if points is None:
+            # read raw block, header is stripped when formatted
+            connection.write( command )
+            return connection.read_raw()
+
+        return connection.query_binary_values(
+            command,
+            datatype = ( 'f' if self.__binary_dtype == '<f4' else 'd' ),
+            is_big_endian = False,
+            container = np.ndarray,
+            data_points = points* self._cols
+        )
+
+
+    def _flush_input( self ):
+        """
+        Discards any unread data in the input buffers
+        so the next read reflects the current state.
+        Disabled after the first failure.
+        """
+        if not self._flush_supported:
+            return
+
+        try:
+            self.instrument.adapter.connection.flush(
+                visa_constants.VI_READ_BUF_DISCARD | visa_constants.VI_IO_IN_BUF_DISCARD
+            )
+
+        except Exception as err:
+            # flush not supported by connection
+            log.warning( 'Could not discard input buffers: %s', err )
+            self._flush_supported = False
+
+
+    def _rearm_buffer( self ):
+        """
+        Clears the buffer and status for the next acquisition,
+        keeping the buffer size from #config_buffer.
+        Unlike #reset_buffer the status is not preset,
+        so the buffer full event stays enabled for #wait_for_buffer.
+        """
+        self.instrument.write( '*cls;:status:measurement:enable 512;:trace:clear;:trace:feed:control next' )
+
+
     def get_elements( self ):
         """
         :returns: List of the saved measurement elements.
@@ -167,23 +386,121 @@ class Keithley2400_Procedure( Procedure ):
         self.instrument.write( f':format:elements {elm_str}' )
         self.__elements = self.get_elements()
 
+        # cache column index of each element
+        self._cols = len( self.__elements )
+        self._elm_idx = { elm: idx for idx, elm in enumerate( self.__elements ) }
+        self._time_idx = self._elm_idx.get( 'TIME' )
+        self._volt_idx = self._elm_idx.get( 'VOLT' )
+        self._curr_idx = self._elm_idx.get( 'CURR' )
+
+
+    def stop( self ):
+        """
+        Request the procedure to stop.
+        Wakes any pending wait immediately,
+        and #should_stop returns True from then on.
+        """
+        log.debug( '#stop' )
+
+        self._stop_event.set()
+
 
     def wait_for( self, seconds, interval = 1 ):
         """
         Sleep for given number of seconds.
         Used to intercept interupts.
+        Returns immediately if #stop is called.
         
         :param seconds: Number of seconds to sleep for.
-        :param interval: Interval to check for an interupt.
+        :param interval: Interval to check for an interupt from the worker.
+            The worker only exposes its stop request by polling.
+        """
+        end_ns = time.monotonic_ns() + int( seconds* 1e9 )
+        remaining = seconds
+        while remaining > 0:
+            self._check_stop()
+            if self._stop_event.wait( timeout = min( interval, remaining ) ):
+                self._check_stop()
+
+            remaining = ( end_ns - time.monotonic_ns() )/ 1e9
+
+
+    def is_idle( self ):
+        """
+        :returns: True if the instrument is in the idle state,
+            False otherwise.
+        """
+        condition = int( float( self.instrument.ask( ':status:operation:condition?' ) ) )
+        return bool( condition & self.IDLE_BIT )
+
+
+    def wait_for_idle( self, timeout, interval = 0.05 ):
         """
-        log.debug( '#wait_for' )
+        Wait until the instrument returns to the idle state,
+        e.g. after a sweep has completed.
+        Used to intercept interupts.
+
+        :param timeout: Maximum number of seconds to wait.
+        :param interval: Interval to poll the instrument. [Default: 0.05]
+        :returns: True if the instrument is idle,
+            False if the timeout was reached.
+        """
+        log.debug( '#wait_for_idle' )
+
+        end_ns = time.monotonic_ns() + int( timeout* 1e9 )
+        while self._polling( end_ns ):
+            if self.is_idle():
+                return True
+
+            self._stop_event.wait( timeout = interval )
 
-        end = time.time() + seconds
-        while time.time() < end:
-            if self.should_stop():
-                # user canceled
-                log.info( 'Procedure stopped by user.' )
-                self.shutdown()
-                raise RuntimeError( 'Procedure stopped by user.' )
+        return False
+
+
+    async def await_idle( self, timeout, interval = 0.05 ):
+        """
+        Wait until the instrument returns to the idle state,
+        yielding to the event loop between polls.
+        Used to intercept interupts.
+
+        :param timeout: Maximum number of seconds to wait.
+        :param interval: Interval to poll the instrument. [Default: 0.05]
+        :returns: True if the instrument is idle,
+            False if the timeout was reached.
+        """
+        log.debug( '#await_idle' )
 
-            time.sleep( interval )
+        end_ns = time.monotonic_ns() + int( timeout* 1e9 )
+        while self._polling( end_ns ):
+            if await asyncio.to_thread( self.is_idle ):
+                return True
+
+            await asyncio.sleep( interval )
+
+        return False
+
+
+    def _polling( self, end_ns ):
+        """
+        Checks for a stop request while polling.
+
+        :param end_ns: Deadline from time.monotonic_ns().
+        :returns: True if the deadline has not been reached.
+        :raises RuntimeError: If the procedure was stopped.
+        """
+        self._check_stop()
+        return ( time.monotonic_ns() < end_ns )
+
+
+    def _check_stop( self ):
+        """
+        Shuts down the procedure if a stop was requested,
+        either by the worker or by #stop.
+
+        :raises RuntimeError: If the procedure was stopped.
+        """
+        if self.should_stop() or self._stop_event.is_set():
+            # user canceled
+            log.info( 'Procedure stopped by user.' )
+            self.shutdown()
+            raise RuntimeError( 'Procedure stopped by user.' )
@@ -1,9 +1,10 @@
 # MPP Tracking
 
+import math
 import time
 import logging
 
-from pymeasure.log import console_log
+import numpy as np
 from pymeasure.experiment import (
     BooleanParameter,
     FloatParameter,
@@ -12,14 +13,63 @@ from pymeasure.experiment import (
 
 from .keithley2400_procedure import Keithley2400_Procedure
 
+try:
+    from numba import njit
+
+except ImportError as err:
+    # numba not installed, use numpy
+    njit = None
 
-# setup logging
-log_level = logging.DEBUG
 
+# setup logging
 log = logging.getLogger( __name__ )
 log.addHandler( logging.NullHandler() )
-console_log( log, level = log_level )
-log.debug( 'Debug logging enabled.' )
+
+
+if njit is not None:
+    @njit( cache = True, fastmath = True )
+    def _aggregate( data, t_idx, v_idx, c_idx ):
+        """
+        Computes mean time, voltage, current, and power
+        in a single pass over the data.
+
+        :param data: 2D numpy.array of measurements.
+        :param t_idx: Column index of time.
+        :param v_idx: Column index of voltage.
+        :param c_idx: Column index of current.
+        :returns: Tuple of ( time, voltage, current, power ) means.
+        """
+        n = data.shape[ 0 ]
+        st = sv = sc = sp = 0.0
+        for i in range( n ):
+            v = data[ i, v_idx ]
+            c = data[ i, c_idx ]
+            st += data[ i, t_idx ]
+            sv += v
+            sc += c
+            sp += v* c
+
+        return ( st/ n, sv/ n, sc/ n, sp/ n )
+
+else:
+    def _aggregate( data, t_idx, v_idx, c_idx ):
+        """
+        Computes mean time, voltage, current, and power.
+
+        :param data: 2D numpy.array of measurements.
+        :param t_idx: Column index of time.
+        :param v_idx: Column index of voltage.
+        :param c_idx: Column index of current.
+        :returns: Tuple of ( time, voltage, current, power ) means.
+        """
+        voltages = data[ :, v_idx ]
+        currents = data[ :, c_idx ]
+        return (
+            data[ :, t_idx ].mean(),
+            voltages.mean(),
+            currents.mean(),
+            ( voltages* currents ).mean()
+        )
 
 
 class MPPTracking_Procedure( Keithley2400_Procedure ):
@@ -58,14 +108,19 @@ class MPPTracking_Procedure( Keithley2400_Procedure ):
         'time [s]', 'voltage [V]', 'current [A]', 'power [W]'
     ]
 
+    TRACE_SIZE = 2500  # maximum number of readings in the instrument buffer
+
+    # state defaults, until set
+    _start_time = None
+    _end_time = None
+    _last_probe_time = None
+
 
     @property
     def measurement_time( self ):
         """
         :returns: Approximate time to measure one data point.
         """
-        log.debug( '.measurement_time' )
-
         return self.buffer_points* 0.065
     
 
@@ -76,14 +131,7 @@ class MPPTracking_Procedure( Keithley2400_Procedure ):
             if the procedure has been executed,
             otherwise None.
         """
-        log.debug( '.start_time' )
-
-        try:
-            return self._start_time
-
-        except AttributeError as err:
-            # procedure not yet started
-            return None
+        return self._start_time
 
 
     @property
@@ -93,14 +141,7 @@ class MPPTracking_Procedure( Keithley2400_Procedure ):
             if the procedure has been executed,
             otherwise None.
         """
-        log.debug( '.end_time' )
-
-        try:
-            return self._end_time
-
-        except AttributeError as err:
-            # procedure not yet started
-            return None
+        return self._end_time
 
 
     @property
@@ -108,14 +149,12 @@ class MPPTracking_Procedure( Keithley2400_Procedure ):
         """
         :returns: Seconds the experiment has been running.
         """
-        log.debug( '.time_elapsed' )
-
         if self.start_time is None:
             # procedure not yet executed
             return 0
 
         else:
-            return ( time.time() - self.start_time )
+            return ( time.monotonic() - self._start_mono )
 
 
     @property
@@ -123,22 +162,22 @@ class MPPTracking_Procedure( Keithley2400_Procedure ):
         """
         :returns: Proportion of procedure complete.
         """
-        log.debug( '.progress' )
-
         if self.start_time is None:
             # procedure not yet executed
             return 0
 
         else:
-            progress = self.time_elapsed/( self.run_time* 60 )  # convert run_time in minutes, to seconds
-            progress = min( progress, 1 )  # cap at 1
-            return progress
+            progress = ( time.monotonic() - self._start_mono )/ self._run_time_s
+            return min( progress, 1 )  # cap at 1
 
 
     def startup( self ):
         """
         Initializes the instrument and variables.
         """
+        if self.probe_points < 1:
+            raise ValueError( 'Probe points must be at least 1.' )
+
         super().startup()
 
         self.instrument.apply_voltage(
@@ -149,6 +188,13 @@ class MPPTracking_Procedure( Keithley2400_Procedure ):
         # set elements
         log.debug( 'Setting elements.' )
         self.set_elements( [ 'time', 'voltage', 'current' ] )
+        self.set_data_format( binary = True )
+
+        # configure buffer once, only reset it for each measurement
+        self.instrument.config_buffer( points = self.buffer_points )
+
+        # ring buffer of most recent baseline powers
+        self._base_ring = np.empty( self.probe_points, dtype = np.float64 )
 
         time.sleep( 0.1 )  # wait to give instrument time to react
 
@@ -159,14 +205,20 @@ class MPPTracking_Procedure( Keithley2400_Procedure ):
         """
         super().execute()
 
+        self._run_time_s = 60* self.run_time  # convert run time from minutes to seconds
+        # monotonic clock for interval arithmetic,
+        # set before start time so progress can use it
+        self._start_mono = time.monotonic()
+        self._end_mono = self._start_mono + self._run_time_s
+
         self._start_time = time.time()
-        self._end_time = self.start_time + 60* self.run_time  # convert run time from minutes to seconds
+        self._end_time = self.start_time + self._run_time_s
 
         probe_direction = 1
         self.instrument.enable_source()
-        self.instrument.source_voltage = self.initial_voltage
+        self._set_voltage( self.initial_voltage )
 
-        while self.progress < 1:
+        while ( time.monotonic() < self._end_mono ) and not self.should_stop():
             # run mpp tracking until end time
             baseline_data = self._baseline()
             probe_data = self._probe( probe_direction )  # leaves voltage at probe voltage
@@ -178,13 +230,13 @@ class MPPTracking_Procedure( Keithley2400_Procedure ):
                 # try to probe in other direction
                 # reset voltage to baseline
                 probe_direction *= -1
-                self.instrument.source_voltage = baseline_voltage
-                log.debug( f'Original voltage was better. Returning to {baseline_voltage} V' )
+                self._set_voltage( baseline_voltage )
+                log.debug( 'Original voltage was better. Returning to %s V', baseline_voltage )
 
             else:
                 # probe voltage is better
                 # do not need to adjust voltage, as the probe step already set it.
-                log.debug( f'Probe voltage is better. New set point is {probe_data[ 0 ]} V.' )
+                log.debug( 'Probe voltage is better. New set point is %s V.', probe_data[ 0 ] )
 
         log.info( 'Experiment complete.' )
 
@@ -192,35 +244,57 @@ class MPPTracking_Procedure( Keithley2400_Procedure ):
     def _baseline( self ):
         """
         Collect baseline data at current voltage.
+        Only the last probe_points powers are kept.
 
-        :returns: Tuple of ( voltage, data ).
+        :returns: Tuple of ( voltage, power sum, number of points ).
         """
         # collect data
         log.debug( '#_baseline' )
 
         # intialize last probe tiem if needed
-        try:
-            self._last_probe_time
-
-        except AttributeError as err:
-            # last probe time not set
-            self._last_probe_time = time.time()
-
-        powers = []
-        while ( time.time() - self._last_probe_time ) < self.probe_interval:
-            cycle_start = time.time()
-            datum = self._measure_datum()
-            powers.append( datum[ 'power' ] )
-
-            # wait for next measurement
+        if self._last_probe_time is None:
+            self._last_probe_time = time.monotonic()
+
+        ring = self._base_ring
+        ring_size = ring.shape[ 0 ]
+        idx = 0
+        count = 0
+        total = 0.0
+        max_points = max( self.TRACE_SIZE// self.buffer_points, 1 )
+        while True:
+            remaining = self.probe_interval - ( time.monotonic() - self._last_probe_time )
+            if remaining <= 0:
+                break
+
+            # collect all data points until the next probe in one acquisition
+            points = math.ceil( remaining/ self.data_interval )
+            points = min( points, max_points )
+            batch_start = time.monotonic()
+            powers = self._measure_batch( points )[ 'power' ]
+
+            for power in powers.tolist():
+                # update ring buffer and running sum
+                if count == ring_size:
+                    # overwrite oldest point
+                    total -= ring[ idx ]
+
+                else:
+                    count += 1
+
+                ring[ idx ] = power
+                total += power
+                idx = ( idx + 1 )% ring_size
+
+            # the first point is taken immediately,
+            # wait out the interval of the last one
             self.wait_for(
                 self._time_remaining(
-                    cycle_start,
-                    self.data_interval
+                    batch_start,
+                    points* self.data_interval
                 )
             )
 
-        return ( self.instrument.source_voltage, powers )
+        return ( self._source_voltage, float( total ), count )
 
 
     def _probe( self, direction = 1 ):
@@ -231,20 +305,20 @@ class MPPTracking_Procedure( Keithley2400_Procedure ):
         :param direction: Probe direction.
             Either 1 or -1.
             [Default: 1] 
-        :returns: Tuple of ( voltage, data ).
+        :returns: Tuple of ( voltage, power sum, number of points ).
         """
         log.debug( '#_probe' )
 
         # set voltage
-        self.instrument.source_voltage += ( direction* self.probe_step )
-        log.debug( f'Probing at {self.instrument.source_voltage} V.' )
+        self._set_voltage( self._source_voltage + direction* self.probe_step )
+        log.debug( 'Probing at %s V.', self._source_voltage )
 
         # collect data
-        powers = []
+        total = 0.0
         for i in range( self.probe_points ):
-            cycle_start = time.time()
+            cycle_start = time.monotonic()
             datum = self._measure_datum()
-            powers.append( datum[ 'power' ] )
+            total += datum[ 'power' ]
 
             # wait for next measurement
             self.wait_for(
@@ -254,36 +328,31 @@ class MPPTracking_Procedure( Keithley2400_Procedure ):
                 )
             )
 
-        self._last_probe_time = time.time()
-        return ( self.instrument.source_voltage, powers )
+        self._last_probe_time = time.monotonic()
+        return ( self._source_voltage, total, self.probe_points )
 
 
     def _better_voltage( self, d1, d2 ):
         """
         Determines the better voltage setting.
 
-        :param d1: Tuple of ( voltage, [ data ] ) to be compared.
-        :param d2: Tuple of ( voltage, [ data ] ) to be compared.
+        :param d1: Tuple of ( voltage, power sum, number of points ) to be compared.
+        :param d2: Tuple of ( voltage, power sum, number of points ) to be compared.
         :returns: Better voltage setting determined by data.
         """
         log.debug( '#_better_voltage' )
-        v1, p1 = d1
-        v2, p2 = d2
-
-        # compare equal number of data points
-        # don't need mean becaseu same number of points,
-        # sum will do.
-        num_points = min( self.probe_points, len( p1 ), len( p2) )
-        m1 = sum( p1[ -num_points: ] )
-        m2 = sum( p2[ -num_points: ] )
-
-        if not self.power_production_mode:
-            # power consumption is measured
-            # power production is negative
-            m1 *= -1
-            m2 *= -1
-
-        if m1 > m2:
+        v1, s1, n1 = d1
+        v2, s2, n2 = d2
+
+        # compare mean power,
+        # number of points may differ
+        m1 = ( s1/ n1 ) if n1 else 0
+        m2 = ( s2/ n2 ) if n2 else 0
+
+        # if power consumption is measured
+        # power production is negative
+        better = ( m1 > m2 ) if self.power_production_mode else ( m1 < m2 )
+        if better:
             # m1 is better
             return v1
 
@@ -293,6 +362,17 @@ class MPPTracking_Procedure( Keithley2400_Procedure ):
             return v2
 
 
+    def _set_voltage( self, voltage ):
+        """
+        Sets the source voltage.
+        The set voltage is tracked to avoid querying the instrument.
+
+        :param voltage: Voltage to set [V].
+        """
+        self.instrument.source_voltage = voltage
+        self._source_voltage = voltage
+
+
     def _measure_datum( self ):
         """
         Measures data, summarizes it, and saves it.
@@ -300,20 +380,18 @@ class MPPTracking_Procedure( Keithley2400_Procedure ):
 
         :returns: Dictionary of summarized data.
         """
-        log.debug( '#_measure_datum' )
-
         # run baseline measurements until it is time for another probe
         data = self._measure()
 
         # take mean over collected data
-        means   = data.mean( axis = 0 )
-        
-        m_time  = means[ self.elements.index( 'TIME' ) ]
+        m_time, voltage, current, power = _aggregate(
+            data,
+            self._time_idx,
+            self._volt_idx,
+            self._curr_idx
+        )
+
         time = self.time_elapsed - m_time  # adjust time for measurement
-        
-        voltage = means[ self.elements.index( 'VOLT' ) ]
-        current = means[ self.elements.index( 'CURR' ) ]
-        power   = data.prod( axis = 1 ).mean()
 
         # save results
         self.emit( 'results', {
@@ -331,19 +409,86 @@ class MPPTracking_Procedure( Keithley2400_Procedure ):
         }
 
 
+    def _measure_batch( self, points ):
+        """
+        Measures multiple data points in a single acquisition,
+        summarizes them, and saves them.
+        The instrument triggers each data point every data_interval seconds
+        and stores all measurements in its buffer, 
+        which is read once at the end.
+
+        :param points: Number of data points to collect.
+        :returns: Dictionary of numpy.arrays of summarized data.
+        """
+        log.debug( '#_measure_batch' )
+
+        readings = points* self.buffer_points
+        batch_start = self.time_elapsed
+
+        self.instrument.config_buffer( points = readings )
+        self.instrument.write( f':trigger:count {self.buffer_points}' )
+        self.instrument.write( ':arm:source timer' )
+        self.instrument.write( f':arm:timer {self.data_interval}' )
+        self.instrument.write( f':arm:count {points}' )
+
+        self._flush_input()
+        self.instrument.start_buffer()
+        self.instrument.wait_for_buffer(
+            should_stop = self.should_stop,
+            timeout = points* self.data_interval* 1.5 + 10
+        )
+
+        self._check_stop()  # buffer is incomplete if stopped
+        data = self.fetch_data( ':trace:data?', points = readings )
+
+        # restore single data point acquisition
+        self.instrument.write( ':arm:source immediate' )
+        self.instrument.write( ':arm:count 1' )
+        self.instrument.config_buffer( points = self.buffer_points )
+
+        # group measurements by data point, take mean over each
+        data = self.format_data( data )
+        data = data.reshape( points, self.buffer_points, data.shape[ 1 ] )
+
+        # only reduce the needed columns
+        voltages = data[ :, :, self._volt_idx ]
+        currents = data[ :, :, self._curr_idx ]
+
+        # time stamps are relative to the first reading in the buffer
+        times = batch_start + data[ :, :, self._time_idx ].mean( axis = 1 )
+
+        # save results
+        results = {
+            'time':    times,
+            'voltage': voltages.mean( axis = 1 ),
+            'current': currents.mean( axis = 1 ),
+            'power':   np.multiply( voltages, currents ).mean( axis = 1 )
+        }
+
+        self._emit_batch( {
+            'time [s]':    results[ 'time' ],
+            'voltage [V]': results[ 'voltage' ],
+            'current [A]': results[ 'current' ],
+            'power [W]':   results[ 'power' ]
+        } )
+
+        return results
+
+
     def _measure( self ):
         """
         Collect data.
+        Stop requests interrupt waiting for the buffer.
 
         :returns: 2D numpy.array of collected data.
         """
-        log.debug( '#_measure' )
-
-        self.instrument.config_buffer( points = self.buffer_points )
+        self._flush_input()
+        self._rearm_buffer()
         self.instrument.start_buffer()
-        self.instrument.wait_for_buffer()
+        self.instrument.wait_for_buffer( should_stop = self.should_stop )
 
-        data = self.instrument.buffer_data
+        self._check_stop()  # buffer is incomplete if stopped
+        data = self.fetch_data( ':trace:data?', points = self.buffer_points )
         data = self.format_data( data )
         return data
 
@@ -352,10 +497,8 @@ class MPPTracking_Procedure( Keithley2400_Procedure ):
         """
         Calculate remaining time in interval.
 
-        :param start: Start time.
+        :param start: Start time from time.monotonic().
         :param interval: Desired interval.
         """
-        log.debug( '#_time_remaining' )
-
-        elapsed = ( time.time() - start )
+        elapsed = ( time.monotonic() - start )
         return ( interval - elapsed )
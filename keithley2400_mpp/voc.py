@@ -1,10 +1,10 @@
 # Voc
 
+import math
 import time
 import logging
+from collections import deque
 
-import numpy as np
-from pymeasure.log import console_log
 from pymeasure.experiment import (
     FloatParameter,
     IntegerParameter
@@ -14,12 +14,8 @@ from .keithley2400_procedure import Keithley2400_Procedure
 
 
 # setup logging
-log_level = logging.DEBUG
-
 log = logging.getLogger( __name__ )
 log.addHandler( logging.NullHandler() )
-console_log( log, level = log_level )
-log.debug( 'Debug logging enabled.' )
 
 
 class Voc_Procedure( Keithley2400_Procedure ):
@@ -49,6 +45,10 @@ class Voc_Procedure( Keithley2400_Procedure ):
         'time [s]', 'voltage [V]', 'current [A]'
     ]
 
+    # state defaults, until set
+    _start_time = None
+    _end_time = None
+
 
     @property
     def start_time( self ):
@@ -57,14 +57,7 @@ class Voc_Procedure( Keithley2400_Procedure ):
             if the procedure has been executed,
             otherwise None.
         """
-        log.debug( '.start_time' )
-
-        try:
-            return self._start_time
-
-        except AttributeError as err:
-            # procedure not yet started
-            return None
+        return self._start_time
 
 
     @property
@@ -74,14 +67,7 @@ class Voc_Procedure( Keithley2400_Procedure ):
             if the procedure has been executed,
             otherwise None.
         """
-        log.debug( '.end_time' )
-
-        try:
-            return self._end_time
-
-        except AttributeError as err:
-            # procedure not yet started
-            return None
+        return self._end_time
 
 
     @property
@@ -89,14 +75,12 @@ class Voc_Procedure( Keithley2400_Procedure ):
         """
         :returns: Seconds the experiment has been running.
         """
-        log.debug( '.time_elapsed' )
-
         if self.start_time is None:
             # procedure not yet executed
             return 0
 
         else:
-            return ( time.time() - self.start_time )
+            return ( time.monotonic() - self._start_mono )
 
 
     @property
@@ -104,19 +88,19 @@ class Voc_Procedure( Keithley2400_Procedure ):
         """
         :returns: Proportion of procedure complete.
         """
-        log.debug( '.progress' )
-
         if self.start_time is None:
             # procedure not yet executed
             return 0
 
         else:
-            progress = self.time_elapsed/ self.max_time
-            progress = min( progress, 1 )  # cap at 1
-            return progress
+            progress = ( time.monotonic() - self._start_mono )/ self.max_time
+            return min( progress, 1 )  # cap at 1
 
 
     def startup( self ):
+        if self.threshold_points < 1:
+            raise ValueError( 'Threshold points must be at least 1.' )
+
         super().startup()
 
         self.instrument.measure_voltage()
@@ -129,27 +113,47 @@ class Voc_Procedure( Keithley2400_Procedure ):
         # set elements
         log.debug( 'Setting elements.' )
         self.set_elements( [ 'time', 'voltage', 'current' ] )
+        self.set_data_format( binary = True )
+
+        # configure buffer once, only reset it for each measurement
+        self.instrument.config_buffer( points = self.buffer_points )
 
         time.sleep( 0.1 )  # wait to give instrument time to react
 
 
     def execute( self ):
         super().execute()
+        # monotonic clock for interval arithmetic,
+        # set before start time so progress can use it
+        self._start_mono = time.monotonic()
+        self._end_mono = self._start_mono + self.max_time
+
         self._start_time = time.time()
         self._end_time = self.start_time + self.max_time
         
         self.instrument.enable_source()
-        data = []
-        while self.progress < 1:
-            datum = self._measure()
-            data.append( datum )
-            if len( data ) > self.threshold_points:
-                # prune data
-                data = data[ : -self.threshold_points ]
 
-            if len( data ) >= self.threshold_points:
+        # keep only the last threshold points,
+        # with running sums for the variance
+        voltages = deque( maxlen = self.threshold_points )
+        v_sum = 0.0
+        v_sq_sum = 0.0
+        while ( time.monotonic() < self._end_mono ) and not self.should_stop():
+            datum = self._measure()
+            voltage = float( datum[ 'voltage' ] )  # accumulate in double precision
+            if len( voltages ) == voltages.maxlen:
+                # oldest point is evicted on append
+                evicted = voltages[ 0 ]
+                v_sum -= evicted
+                v_sq_sum -= evicted* evicted
+
+            voltages.append( voltage )
+            v_sum += voltage
+            v_sq_sum += voltage* voltage
+
+            if len( voltages ) >= self.threshold_points:
                 # only check settled if enough points have been taken
-                if self._settled( data ):
+                if self._settled( v_sum, v_sq_sum, len( voltages ) ):
                     # data is settled
                     # end program
                     log.debug( 'Voltage settled.' )
@@ -164,18 +168,16 @@ class Voc_Procedure( Keithley2400_Procedure ):
 
         :returns: 2D numpy.array of collected data.
         """
-        log.debug( '#_measure' )
-
         data = self._get_data()
         data = self.format_data( data )
         
         # save data
         means = data.mean( axis = 0 )
-        m_time  = means[ self.elements.index( 'TIME' ) ]
+        m_time  = means[ self._time_idx ]
         time = self.time_elapsed - m_time  # adjust time to account for measurement
         
-        voltage = means[ self.elements.index( 'VOLT' ) ]
-        current = means[ self.elements.index( 'CURR' ) ]
+        voltage = means[ self._volt_idx ]
+        current = means[ self._curr_idx ]
 
         # save results
         self.emit( 'results', {
@@ -198,7 +200,7 @@ class Voc_Procedure( Keithley2400_Procedure ):
         :returns: Data from the instrument.
         """
         try:
-            self.instrument.config_buffer( points = self.buffer_points )
+            self._rearm_buffer()
             self.instrument.start_buffer()
             self.instrument.wait_for_buffer()
 
@@ -206,26 +208,20 @@ class Voc_Procedure( Keithley2400_Procedure ):
             log.debug( err )
             self.shutdown()
         
-        data = self.instrument.buffer_data
+        data = self.fetch_data( ':trace:data?', points = self.buffer_points )
         return data
 
 
-    def _settled( self, data ):
+    def _settled( self, v_sum, v_sq_sum, n ):
         """
         Determine whether the given data is considered settled.
 
-        :param data: List of datum items.
+        :param v_sum: Sum of voltages.
+        :param v_sq_sum: Sum of squared voltages.
+        :param n: Number of voltages summed.
         :returns: Whether the data is considered settled.
         """
-        voltage = self._extract_voltage( data )
-        v_std = voltage.std()
-        return ( v_std <= self.std_threshold )
-
+        mean = v_sum/ n
+        var = max( v_sq_sum/ n - mean* mean, 0 )  # clip round off error
+        return ( math.sqrt( var ) <= self.std_threshold )
 
-    @staticmethod    
-    def _extract_voltage( self, data ):
-        """
-        :param data: List of datum dictionaries.
-        :returns: numpy.ndarray of voltage data. 
-        """
-        return np.array( list( map( lambda x: x[ 'voltage' ], data ) ) )
\ No newline at end of file
@@ -8,8 +8,10 @@ def main( port, run_voc = True, run_jv = True, run_mpp = True, **kwargs ):
 
 	import pandas as pd
 	from pymeasure.log import console_log
+	from pymeasure.instruments.keithley import Keithley2400
 	from pymeasure.experiment import Results, Worker
 
+	from keithley2400_mpp import enable_console_logging
 	from keithley2400_mpp.voc import Voc_Procedure
 	from keithley2400_mpp.jv import JVScan_Procedure
 	from keithley2400_mpp.mpp_tracking import MPPTracking_Procedure
@@ -21,6 +23,7 @@ def main( port, run_voc = True, run_jv = True, run_mpp = True, **kwargs ):
 	log = logging.getLogger( __name__ )
 	log.addHandler( logging.NullHandler() )
 	console_log( log, level = log_level )
+	enable_console_logging( level = log_level )
 	log.debug( 'Debug logging enabled.' )
 
 
@@ -34,6 +37,11 @@ def main( port, run_voc = True, run_jv = True, run_mpp = True, **kwargs ):
 		'backupCount': 10
 	}
 
+	# share one connection between procedures,
+	# only reset before the first
+	instrument = Keithley2400( port )
+	reset_instrument = True
+
 	# --- setup voc ---
 	log.debug( 'Initializing Voc procedure.' )
 
@@ -92,6 +100,9 @@ def main( port, run_voc = True, run_jv = True, run_mpp = True, **kwargs ):
 	# Voc
 	if run_voc:
 		log.info( 'Starting Voc.' )
+		voc_proc.use_shared_instrument( instrument, reset = reset_instrument )
+		reset_instrument = False
+
 		voc_results = Results( voc_proc, voc_data_filename, recorder_args = recorder_args )
 		voc = Worker( voc_results )
 
@@ -122,6 +133,9 @@ def main( port, run_voc = True, run_jv = True, run_mpp = True, **kwargs ):
 			jv_run_time *= 2
 
 		log.info( 'Starting JV scan.' )
+		jv_proc.use_shared_instrument( instrument, reset = reset_instrument )
+		reset_instrument = False
+
 		jv_results = Results( jv_proc, jv_data_filename, recorder_args = recorder_args )
 		jv = Worker( jv_results )
 
@@ -145,6 +159,9 @@ def main( port, run_voc = True, run_jv = True, run_mpp = True, **kwargs ):
 	# MPP
 	if run_mpp:
 		log.info( 'Starting MPP tracking.' )
+		mpp_proc.use_shared_instrument( instrument, reset = reset_instrument )
+		reset_instrument = False
+
 		mpp_results = Results( mpp_proc, mpp_data_filename, recorder_args = recorder_args )
 
 		mpp = Worker( mpp_results )
@@ -22,8 +22,12 @@ setuptools.setup(
     ],
     install_requires=[
         'numpy',
-        'pymeasure'
+        'pymeasure',
+        'pyvisa'
     ],
+    extras_require={
+        'numba': [ 'numba' ]
+    },
     package_data={
     }
 )
\ No newline at end of file